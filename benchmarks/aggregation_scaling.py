@@ -0,0 +1,62 @@
+# aggregation_scaling.py
+
+# Scaling benchmark of the sharded aggregation stage, from 1 to N processes.
+# It runs on the intermediate datasets of a city already set up, e.g.
+#   python benchmarks/aggregation_scaling.py Madrid -N 8
+
+import argparse
+import time
+import geopandas as gpd
+import pandas as pd
+from geopandas.testing import assert_geodataframe_equal
+from proxi_API.data.settings import H3_ZOOM, YEAR
+from proxi_API.model import data_aggregation, mobility_indices, h3_mapping
+from proxi_API.model.setup_city import out
+
+
+def load(CITY, year):
+    """
+    Reads the inputs of the aggregation stage, as written by the setup.
+    """
+    proximity = gpd.read_parquet(out / f"{CITY}_{H3_ZOOM}_proximity.parquet")
+    streets = pd.read_parquet(out / f"{CITY}_{H3_ZOOM}_streets.parquet")
+    pedestrian_pairs = pd.read_parquet(out / f"{CITY}_{H3_ZOOM}_pairs_pedestrian.parquet")
+    demo_pairs = pd.read_parquet(out / f"{CITY}_{H3_ZOOM}_pairs_demo.parquet")
+    sdemo = pd.read_parquet(out / f"{CITY}_{H3_ZOOM}_demo_{year}.parquet")
+    return proximity, streets, pedestrian_pairs, demo_pairs, sdemo
+
+
+def run(inputs, n_jobs):
+    """
+    Runs the aggregation stage as the setup does.
+    """
+    agg = data_aggregation.main(*inputs, n_jobs)
+    agg = mobility_indices.main(agg)
+    agg = agg.reset_index(drop=True)
+    return h3_mapping.main(agg, n_jobs=n_jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling of the aggregation stage.")
+    parser.add_argument("city", type=str, help="City already set up.")
+    parser.add_argument("-N", type=int, default=4, help="Maximum number of processes.")
+    parser.add_argument("-Y", type=int, default=YEAR, help="Year of the sociodemographic data.")
+    args = parser.parse_args()
+
+    inputs = load(args.city, args.Y)
+    serial = None
+    for n_jobs in range(1, args.N + 1):
+        start = time.perf_counter()
+        result = run(inputs, n_jobs)
+        elapsed = time.perf_counter() - start
+
+        if serial is None:
+            serial, base = result, elapsed
+        else:
+            assert_geodataframe_equal(result, serial)  # Sharding must not change the output
+
+        print(f"{n_jobs} processes: {elapsed:.2f} s (speedup {base / elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
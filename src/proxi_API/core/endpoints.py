@@ -1,7 +1,8 @@
 # endpoints.py
 from typing import Annotated
 from enum import Enum
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 import asyncio
 import logging
 from proxi_API.model import setup_city
@@ -9,7 +10,9 @@ import datetime
 import uuid
 from proxi_API.schemas import schemas
 from proxi_API.model.mobility_indices import metric_comp
-from proxi_API.data.settings import H3_ZOOM
+from proxi_API.model import cell_index
+from proxi_API.model import export
+from proxi_API.data.settings import H3_ZOOM, YEAR
 from pathlib import Path
 
 router = APIRouter()  # Loading the endpoints in a router.
@@ -54,19 +57,33 @@ class AvailableCities(str, Enum):
     Madrid = 'Madrid'
     Oviedo = "Oviedo"
     Viladecans = 'Viladecans'
-    
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+    geoparquet = "geoparquet"
+    arrow = "arrow"
+
+
+class Compression(str, Enum):
+    none = "none"
+    gzip = "gzip"
+    zstd = "zstd"
+
 
 # Endpoint to setup the model for a given city (currently, the city is being read from data/settings.py)
 @router.get(
     "/setup/{city}", summary="Setup the app for a given city.", tags=["Proximity time"]
 )
-async def setup(city: AvailableCities):
+async def setup(city: AvailableCities, year: Annotated[list[int], Query()] = [YEAR]):
     """
     Perform asynchronous setup for processing a city model.
 
     This function orchestrates the setup of a city's model by:
     - Generating a unique task identifier.
     - Creating necessary folder structures inside (`data/cities`)
+    - Storing the census geometries once, shared by all the years of sociodemographic data
     - Spawning an asynchronous task that sequentially runs:
         - Serves a map in geojson format containing the proximity time for the given city.
         - Computes proximity time for the different types of pedestrians (residents, tourists, workers/students, leisure, access to hospitality, access to public transport)
@@ -75,6 +92,7 @@ async def setup(city: AvailableCities):
 
     ### Parameters:
     - city (choice): City to setup the model for. Select from the list.
+    - year (list): Years of sociodemographic data to setup. Years already set up are skipped.
     
     ### Returns:
     - `dict`: A dictionary with the key `'task_id'` mapped to the unique identifier of the asynchronous task.
@@ -84,6 +102,10 @@ async def setup(city: AvailableCities):
       operations for network or POI preparations.
 
     """
+    missing = set(year) - set(setup_city.available_years())
+    if missing:
+        raise HTTPException(status_code=404, detail=f"No sociodemographic data for {sorted(missing)}.")
+
     task_id = str(uuid.uuid4())  # Generate a unique ID for the task
     logger.info(f"Starting run with task ID: {task_id}")
 
@@ -91,7 +113,7 @@ async def setup(city: AvailableCities):
         try:
 
             logger.info("Running - Preparing datasets")
-            await asyncio.to_thread(setup_city.main, city.value)
+            await asyncio.to_thread(setup_city.main, city.value, year)
 
             logger.info(f"Run with task ID: {task_id} finished")
         except asyncio.CancelledError:
@@ -115,7 +137,7 @@ async def setup(city: AvailableCities):
     summary="Computes the proximity time and metrics.",
     tags=["Proximity time"],
 )
-async def prox_time(city: AvailableCities,input: schemas.InputSliders):
+async def prox_time(city: AvailableCities,input: schemas.InputSliders, year: int = YEAR):
     """
     Computes global metrics associated to te accesibility of the city.
 
@@ -136,20 +158,169 @@ async def prox_time(city: AvailableCities,input: schemas.InputSliders):
     ### Parameters:
     - city (choice): City to compute the metrics for. Select from the list.
     - `sliders` (array): Six dimensional array containing the numerical weights for each category of pedestrians
+    - year (int): Year of the sociodemographic data.
 
     ### Returns:
     - `dict`: A dictionary containing the metrics and indices.
     """
     out = Path(__file__).parents[1] / "data" / "cities"
 
-    if not Path(out / f"{city.value}_{H3_ZOOM}_agg.geojson").is_file():
-        raise HTTPException(status_code=404, detail=f"{city.value} is not available. Run Setup first. ")
+    if not Path(out / f"{city.value}_{H3_ZOOM}_{year}_agg.geojson").is_file():
+        raise HTTPException(status_code=404, detail=f"{city.value} ({year}) is not available. Run Setup first. ")
 
-    result = metric_comp(city.value, input.sliders)
+    result = metric_comp(city.value, input.sliders, year)
 
     return result
 
 
+# Endpoint to look up the proximity time at a location
+@router.get(
+    "/point/{city}",
+    summary="Query the proximity time at a location.",
+    tags=["Proximity time"],
+)
+async def point(
+    city: AvailableCities,
+    lat: Annotated[float, Query(ge=-90, le=90)],
+    lon: Annotated[float, Query(ge=-180, le=180)],
+    year: int = YEAR,
+    geometry: bool = False,
+):
+    """
+    Returns the data of the H3 cell containing a location.
+
+    The cell is found by hashing the coordinates to their H3 ID, so the answer does not depend on the size of the city.
+
+    ### Parameters:
+    - city (choice): City to query. Select from the list.
+    - lat (float): Latitude of the location, between -90 and 90.
+    - lon (float): Longitude of the location, between -180 and 180.
+    - year (int): Year of the sociodemographic data.
+    - geometry (bool): Include the polygon of the cell, in GeoJSON format.
+
+    ### Returns:
+    - `dict`: A dictionary with the proximity time, indices and H3 ID of the cell.
+    """
+    if not cell_index.source(city.value, year).is_file():
+        raise HTTPException(status_code=404, detail=f"{city.value} ({year}) is not available. Run Setup first. ")
+
+    # The first request for a city reads its cell table, keep it off the event loop
+    await asyncio.to_thread(cell_index.load, city.value, year)
+    result = cell_index.point(city.value, lat, lon, year, geometry)
+
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No data for this location in {city.value}.")
+
+    return result
+
+
+# Endpoint to look up the proximity time inside an area
+@router.post(
+    "/polygon/{city}",
+    summary="Query the proximity time inside an area.",
+    tags=["Proximity time"],
+)
+async def polygon(
+    city: AvailableCities, input: schemas.InputPolygon, year: int = YEAR, geometry: bool = False
+):
+    """
+    Returns the data of the H3 cells whose center lies inside a polygon.
+
+    ### Parameters:
+    - city (choice): City to query. Select from the list.
+    - `polygon` (GeoJSON): Polygon delimiting the area, with coordinates in (lon, lat) order.
+    - year (int): Year of the sociodemographic data.
+    - geometry (bool): Include the polygons of the cells, in GeoJSON format.
+
+    ### Returns:
+    - `list`: A list of dictionaries with the proximity time, indices and H3 ID of each cell.
+    """
+    if not cell_index.source(city.value, year).is_file():
+        raise HTTPException(status_code=404, detail=f"{city.value} ({year}) is not available. Run Setup first. ")
+
+    # The lookup is bounded by the size of the city, but keep it off the event loop
+    return await asyncio.to_thread(
+        cell_index.polygon, city.value, input.model_dump(), year, geometry
+    )
+
+
+# Endpoint to download the aggregated data of a city
+@router.get(
+    "/export/{city}",
+    summary="Download the aggregated data of a city.",
+    tags=["Proximity time"],
+)
+async def export_city(
+    city: AvailableCities,
+    request: Request,
+    format: ExportFormat = ExportFormat.ndjson,
+    compression: Compression = Compression.none,
+    columns: Annotated[list[str] | None, Query()] = None,
+    year: int = YEAR,
+):
+    """
+    Streams the aggregated data of a city, one row per H3 cell.
+
+    The data is encoded in chunks as it is sent, so the download starts right away whatever the size of the city.
+    Once a download completes, the file is kept on the server (up to a total size, and until the city is set up
+    again) and further requests support `Range` and `If-Range`, so that interrupted downloads can be resumed. A `Range` request for an export not generated yet waits for it.
+
+    ### Parameters:
+    - city (choice): City to export. Select from the list.
+    - format (choice): `ndjson`, `csv`, `geoparquet` (with the hexagons rebuilt from `h3_id`) or `arrow` (IPC stream).
+    - compression (choice): `none`, `gzip` or `zstd`.
+    - columns (list): Columns to export, in the order of the table. All of them by default.
+    - year (int): Year of the sociodemographic data.
+
+    ### Returns:
+    - The file, with an `ETag` identifying its content.
+    """
+    if not export.source(city.value, year).is_file():
+        raise HTTPException(status_code=404, detail=f"{city.value} ({year}) is not available. Run Setup first. ")
+
+    available = export.available_columns(city.value, year)
+    unknown = [col for col in columns or [] if col not in available]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {unknown}")
+    # Columns keep the order of the table, so that the same selection is exported and cached once
+    columns = [col for col in available if col in columns] if columns else available
+
+    args = (city.value, year, format.value, compression.value, columns)
+    tag = export.etag(*args)
+    if request.headers.get("if-none-match") == tag:
+        return Response(status_code=304, headers={"etag": tag})
+
+    path = export.cached(city.value, year, tag, format.value, compression.value)
+    name = export.filename(city.value, year, format.value, compression.value)
+    media_type = export.media_type(format.value, compression.value)
+
+    # FileResponse compares If-Range with its own stat-based ETag, so it is checked here against the ETag of the
+    # export instead: if it matches, only Range is passed on, otherwise Range is dropped and the whole file is sent
+    if_range = request.headers.get("if-range")
+    use_range = "range" in request.headers and if_range in (None, tag)
+    if if_range is not None:
+        drop = b"if-range" if if_range == tag else b"range"
+        request.scope["headers"] = [
+            (key, value) for key, value in request.scope["headers"] if key != drop
+        ]
+
+    if not path.is_file() and use_range:
+        await asyncio.to_thread(export.write, *args, path)
+
+    if path.is_file():
+        return FileResponse(path, media_type=media_type, filename=name, headers={"etag": tag})
+
+    return StreamingResponse(
+        export.stream(*args, cache=path),
+        media_type=media_type,
+        headers={
+            "etag": tag,
+            "accept-ranges": "bytes",
+            "content-disposition": f'attachment; filename="{name}"',
+        },
+    )
+
+
 #####################
 ###Task management###
 ####################
@@ -4,3 +4,9 @@
 
 N_CORES = 4  # Number of cores to use for the computation at setup
 H3_ZOOM = 9  # Zoom of H· (9 by default from SONY data)
+LEAN_DTYPES = True  # Read ingestion shards with float32/categorical dtypes instead of float64/object
+MEMORY_BUDGET_MB = 2048  # Uncompressed size of the fragments read at once during setup (None reads them all)
+YEAR = 2024  # Default vintage of the sociodemographic data
+EXPORT_BATCH = 10_000  # Rows per row group of the cell tables, and per chunk of the exports
+EXPORT_CACHE_MB = 1024  # Size of the completed exports kept on disk, the oldest are removed beyond it
+SHARD_ZOOM = 6  # Zoom of the H3 parent cells used to shard the aggregation across processes
@@ -0,0 +1,123 @@
+# cell_index.py
+
+import h3
+import numpy as np
+import pandas as pd
+import shapely
+import threading
+from pathlib import Path
+from proxi_API.data.settings import H3_ZOOM, YEAR
+
+out = Path(__file__).parents[1] / "data" / "cities"
+
+indices = {}  # Cache of the loaded indices and their extents, keyed by (city, year)
+lock = threading.Lock()  # Lookups run in threads, so an index is loaded once and published whole
+
+
+def source(CITY, year=YEAR):
+    """
+    Path of the geometry-free cell table of a city.
+    """
+    return out / f"{CITY}_{H3_ZOOM}_{year}_cells.parquet"
+
+
+def extent(index):
+    """
+    Bounding box of the cells of an index, as (lon_min, lat_min, lon_max, lat_max).
+    """
+    vertices = np.array(
+        [vertex for h3_id in index for vertex in h3.cell_to_boundary(h3_id)]
+    ).reshape(-1, 2)
+    return (*vertices.min(axis=0)[::-1], *vertices.max(axis=0)[::-1])
+
+
+def load(CITY, year=YEAR):
+    """
+    Returns the hash index of a city and its extent, reading its geometry-free cell table the first time.
+
+    Parameters:
+        CITY (str): Name of the city
+        year (optional, int): Vintage of the sociodemographic data
+
+    Returns:
+        dict: Mapping from H3 ID to the record of the cell
+        tuple: Bounding box of the cells, None if the city has no cells
+    """
+    key = (CITY, year)
+    if key not in indices:
+        with lock:
+            if key not in indices:
+                df = pd.read_parquet(source(CITY, year))
+                df = df.astype(object).replace({np.nan: None})  # NaN is not valid JSON
+                index = {record["h3_id"]: record for record in df.to_dict("records")}
+                indices[key] = (index, extent(index) if index else None)
+    return indices[key]
+
+
+def cell_geometry(h3_id):
+    """
+    Rebuilds the polygon of an H3 cell from its ID.
+
+    Parameters:
+        h3_id (str): H3 ID of the hexagon
+
+    Returns:
+        dict: GeoJSON polygon, in (lon, lat) order
+    """
+    ring = [[lng, lat] for lat, lng in h3.cell_to_boundary(h3_id)]
+    return {"type": "Polygon", "coordinates": [ring + ring[:1]]}
+
+
+def with_geometry(record):
+    """
+    Copies a record adding the polygon of its cell.
+    """
+    return {**record, "geometry": cell_geometry(record["h3_id"])}
+
+
+def point(CITY, lat, lon, year=YEAR, geometry=False):
+    """
+    Finds the cell containing a location.
+
+    Parameters:
+        CITY (str): Name of the city
+        lat (float): Latitude of the location
+        lon (float): Longitude of the location
+        year (optional, int): Vintage of the sociodemographic data
+        geometry (optional, bool): Whether to include the polygon of the cell
+
+    Returns:
+        dict: Record of the cell, None if the location is outside the city
+    """
+    index, _ = load(CITY, year)
+    record = index.get(h3.latlng_to_cell(lat, lon, H3_ZOOM))
+    if record is not None and geometry:
+        record = with_geometry(record)
+    return record
+
+
+def polygon(CITY, geojson, year=YEAR, geometry=False):
+    """
+    Finds the cells whose center lies inside a polygon. The polygon is clipped to the extent of the city first,
+    so that the number of cells to check is bounded by the size of the city and not by the size of the query.
+
+    Parameters:
+        CITY (str): Name of the city
+        geojson (dict): GeoJSON polygon, in (lon, lat) order
+        year (optional, int): Vintage of the sociodemographic data
+        geometry (optional, bool): Whether to include the polygons of the cells
+
+    Returns:
+        list: Records of the cells of the city inside the polygon
+    """
+    index, bounds = load(CITY, year)
+    if not index:
+        return []
+    area = shapely.clip_by_rect(shapely.geometry.shape(geojson), *bounds)
+    if area.is_empty or area.area == 0:
+        return []
+    cells = h3.polygon_to_cells(h3.geo_to_h3shape(area), H3_ZOOM)
+    records = [index[cell] for cell in cells if cell in index]
+    if geometry:
+        records = [with_geometry(record) for record in records]
+    return records
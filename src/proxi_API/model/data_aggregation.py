@@ -1,4 +1,7 @@
 import numpy as np
+import pandas as pd
+from proxi_API.model.data_processing import concat_shards
+from proxi_API.model.sharding import shard_keys, group_shards, dissolve_shards
 from pathlib import Path
 
 data = Path(__file__).parents[1] / "data" / "cities"  # Data path
@@ -43,33 +46,78 @@ def agg(col):
         return "mean"  # for columns indicating ratios, we average them
 
 
-def main(pedestrian, proximity, sdemo):
+def index_pairs(proximity, df):
     """
-    Aggregates the datasets by using spatial joins. It projects the street info into the cells of the proximity dataset.
+    Finds the cells of the proximity dataset intersecting each geometry of a dataset.
 
     Parameters:
-        pedestrian (df): Dataset containing the information about pedestrian flow
         proximity (df): Dataset containing the information about proximity time
-        sdemo (df): Dataset containing socio-demographic data
+        df (df): Dataset with the geometries to match
 
     Returns:
-        df: Dataset with aggregated data
+        df: Positions of the matching cells (`cell`) and geometries (`row`)
     """
-    prox = proximity.set_crs(proximity.crs)
-    proximity_expanded = prox.sjoin(
-        pedestrian, how="inner", predicate="intersects"
-    ).drop("index_right", axis="columns")
+    row, cell = proximity.sindex.query(df.geometry, predicate="intersects")
+    return pd.DataFrame({"cell": cell, "row": row})
 
-    proximity_expanded = proximity_expanded.sjoin(
-        sdemo, how="inner", predicate="intersects"
-    )
 
+def prepare_streets(batches, proximity):
+    """
+    Reduces the pedestrian dataset, read in batches, to what the aggregation needs. The geometry of each batch is
+    only used to pair the streets with the proximity cells and to shard them, and is dropped before reading the next.
+
+    Parameters:
+        batches (iterable): Batches of the dataset containing the information about pedestrian flow
+        proximity (df): Dataset containing the information about proximity time
+
+    Returns:
+        df: Streets without geometry, with the `_total` columns, `geoid` and `shard`
+        df: Positions of the intersecting cells (`cell`) and streets (`row`)
+    """
+    streets, index, offset = [], [], 0
+    for batch in batches:
+        batch_pairs = index_pairs(proximity, batch)
+        batch_pairs["row"] += offset
+        index.append(batch_pairs)
+        df = pd.DataFrame(batch.drop(columns=batch.geometry.name))
+        df["shard"] = shard_keys(batch.geometry)
+        streets.append(df)
+        offset += len(batch)
+
+    streets = concat_shards(streets)
+    streets["shard"] = group_shards(streets["shard"].values, streets["geoid"].astype(str))
+    return streets, pd.concat(index, ignore_index=True)
+
+
+def main(proximity, streets, pedestrian_pairs, demo_pairs, sdemo, n_jobs=1):
+    """
+    Aggregates the datasets by using the precomputed spatial joins. It projects the street info into the cells of the proximity dataset.
+    Streets are sharded by coarse H3 cell, keeping all the streets with the same geoid together, and dissolved in parallel.
+
+    Parameters:
+        proximity (df): Dataset containing the information about proximity time
+        streets (df): Streets without geometry, as returned by `prepare_streets`
+        pedestrian_pairs (df): Pairs of proximity cells (`cell`) and pedestrian rows (`row`) intersecting
+        demo_pairs (df): Pairs of proximity cells (`cell`) and census sections (`geoid`) intersecting
+        sdemo (df): Dataset containing socio-demographic data (`geoid`, `p_t`) for a given year
+        n_jobs (optional, int): Number of processes
+
+    Returns:
+        df: Dataset with aggregated data
+    """
+    expanded = pedestrian_pairs.merge(demo_pairs, on="cell").merge(sdemo, on="geoid")
+
+    cells = proximity.take(expanded["cell"].values).reset_index(drop=True)
+    rows = streets.take(expanded["row"].values).reset_index(drop=True)
+    keys = rows.pop("shard").values
+    proximity_expanded = cells.join(rows.rename(columns={"geoid": "geoid_left"}))
+    proximity_expanded["geoid_right"] = expanded["geoid"].values
+    proximity_expanded["p_t"] = expanded["p_t"].values
 
     drop_cols = [
         col
         for col in proximity_expanded.columns
-        if type(proximity_expanded[col].values[0]) != np.float64
-        and type(proximity_expanded[col].values[0]) != float
+        if type(proximity_expanded[col].values[0]) not in (np.float64, np.float32, float)
     ]
     aggdict = {
         col: agg(col)
@@ -78,9 +126,13 @@ def main(pedestrian, proximity, sdemo):
     }
     aggdict["geoid_left"] = "first"
     aggdict['p_t'] = 'sum'
-    proximity_aggregated = proximity_expanded.dissolve(
+    proximity_aggregated = dissolve_shards(
+        proximity_expanded,
+        keys,
         by="geoid_left",
         aggfunc=aggdict,
+        n_jobs=n_jobs,
+        observed=True,  # geoid may be categorical, skip the ids outside the city
     )
 
     return proximity_aggregated
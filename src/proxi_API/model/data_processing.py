@@ -1,29 +1,119 @@
 import geopandas as gpd
-import numpy as np
+import pandas as pd
+import logging
+import resource
+import shutil
+import pyarrow.parquet as pq
+from joblib import Parallel, delayed
+from pathlib import Path
+from pandas.api.types import union_categoricals
+from proxi_API.data.settings import N_CORES, LEAN_DTYPES, MEMORY_BUDGET_MB
 
+# Set logger for logging info
+logger = logging.getLogger("uvicorn.error")
 
-def get_city(path, bbox):
+# Columns kept from each source, the rest of the csv is never loaded
+pedestrian_cols = [
+    "imd",
+    "visita_tur_stica",
+    "trabajadores_estudiantes",
+    "residentes",
+    "compras_ocio",
+    "acceso_hosteler_a",
+    "acceso_tpte_p_blico",
+]
+demo_cols = ["p_t"]
+
+
+def schema(columns):
     """
-    Reads a csv in the unica_sociodemographics folder, formats it appropiately as a geoDataFrame and restricts it to the bbox.
+    Dtypes used to read the numerical columns of a shard, together with its id and geometry.
+    Parameters:
+        columns (list): Numerical columns to read.
+    Return:
+        (dict): Mapping from column name to dtype, suitable for `pd.read_csv`.
+
+    """
+
+    dtypes = {col: "float32" if LEAN_DTYPES else "float64" for col in columns}
+    dtypes["geoid"] = "category" if LEAN_DTYPES else str
+    dtypes["geom"] = str
+    return dtypes
+
+
+def trim(df):
+    """
+    Drops the categories of `geoid` that are not present in the dataframe. Shards are national,
+    so the ids of the whole country should not be carried around once cropped to the bbox.
+    """
+
+    if LEAN_DTYPES:
+        df["geoid"] = df["geoid"].cat.remove_unused_categories()
+    return df
+
+
+def crop(df, bbox):
+    """
+    Parses the WKT geometries of a shard and restricts it to the bbox.
+    Parameters:
+        df (dataFrame): Shard with the geometries in the `geom` column, as text.
+        bbox (list): Array containing the bounding box, in format [x_min, y_min, x_max, y_max].
+    Return:
+        (geoDataFrame): Dataframe restricted to the bounding box.
+
+    """
+
+    df = gpd.GeoDataFrame(df, geometry=gpd.GeoSeries.from_wkt(df.pop("geom")))
+    df = df.rename_geometry("geom")
+    return df.cx[bbox[0] : bbox[2], bbox[1] : bbox[3]].copy()
+
+
+def read_shard(path, bbox, columns):
+    """
+    Reads only the needed columns of a csv shard, formats it as a geoDataFrame and restricts it to the bbox.
     Parameters:
         path (str): Path of the file to read.
         bbox (list): Array containing the bounding box, in format [x_min, y_min, x_max, y_max].
+        columns (list): Numerical columns to keep.
     Return:
         (geoDataFrame): Dataframe restricted to the bounding box.
 
     """
 
-    df = gpd.read_file(path)
-    df = df.replace("", np.nan, regex=True)
-    for col in [c for c in df.columns if c not in ["geom", "geoid", "do_date"]]:
-        try:
-            df[col] = df[col].astype(float)
-        except:
-            df[col] = df[col].astype(str)
+    dtypes = schema(columns)
+    df = pd.read_csv(path, usecols=list(dtypes), dtype=dtypes)
+    return trim(crop(df, bbox))
+
+
+def get_census(path, bbox, known):
+    """
+    Reads a csv in the unica_sociodemographics folder of a given year, keeping the populated census sections.
+    Only the sections missing from the geometry store have their geometry parsed and cropped to the bbox,
+    the rest are matched by `geoid`.
+    Parameters:
+        path (str): Path of the file to read.
+        bbox (list): Array containing the bounding box, in format [x_min, y_min, x_max, y_max].
+        known (set): Ids of the sections already in the geometry store.
+    Return:
+        (dataFrame): Population of the sections of the city.
+        (geoDataFrame): Geometries of the sections of the city missing from the store.
+
+    """
+
+    dtypes = schema(demo_cols)
+    df = pd.read_csv(path, usecols=list(dtypes), dtype=dtypes)
+    df = df[df["p_t"] != 0]
+    stored = df["geoid"].isin(known)
 
-    df["geom"] = gpd.GeoSeries.from_wkt(df.geom)
-    df = df.set_geometry("geom")
-    return df.cx[bbox[0] : bbox[2], bbox[1] : bbox[3]]
+    geometries = crop(df.loc[~stored, ["geoid", "geom"]], bbox)
+    attributes = pd.concat(
+        [
+            df.loc[stored, ["geoid", "p_t"]],
+            df.loc[geometries.index, ["geoid", "p_t"]],
+        ],
+        ignore_index=True,
+    )
+    return trim(attributes), trim(geometries)
 
 
 def get_streets(path, bbox):
@@ -37,20 +127,264 @@ def get_streets(path, bbox):
 
     """
 
-    df = gpd.read_file(path)
-    df = df.replace("", np.nan, regex=True)
-    for col in [
-        "imd",
-        "visita_tur_stica",
-        "trabajadores_estudiantes",
-        "residentes",
-        "compras_ocio",
-        "acceso_hosteler_a",
-        "acceso_tpte_p_blico",
-        "total",
-    ]:
-        df[col] = df[col].astype(float)
-
-    df["geom"] = gpd.GeoSeries.from_wkt(df.geom)
-    df = df.set_geometry("geom")
-    return df.cx[bbox[0] : bbox[2], bbox[1] : bbox[3]]
+    return read_shard(path, bbox, pedestrian_cols)
+
+
+def frame_memory(df):
+    """
+    Memory held by a dataframe, in bytes, including the content of string columns.
+    """
+
+    return int(df.memory_usage(deep=True).sum())
+
+
+def peak_memory():
+    """
+    Peak resident memory of the current process, in MB.
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def memory_report(stage, df=None, peak=None):
+    """
+    Logs the peak memory of a stage and, optionally, the size of a dataframe. Stages running in the joblib
+    workers measure their peak there and pass it, since the peak of the parent process does not include them.
+    Loky reuses its workers, so their peak covers every task they ran so far, not only the last stage.
+    MEMORY_BUDGET_MB only bounds the batches of fragments read at once, not the aggregation stage.
+    Parameters:
+        stage (str): Name of the stage being reported.
+        df (optional, dataFrame): Dataframe produced by the stage.
+        peak (optional, float): Peak memory measured in the workers, in MB. The peak of this process by default.
+
+    """
+
+    where = "process" if peak is None else "workers"
+    peak = peak_memory() if peak is None else peak
+    message = f"Memory at {stage}: peak RSS of the {where} {peak:.0f} MB"
+    if df is not None:
+        message += f", dataset {frame_memory(df) / 1024**2:.1f} MB ({len(df)} rows)"
+    logger.info(message)
+
+
+def to_fragment(df, path):
+    """
+    Writes a shard as a parquet fragment, with `geoid` stored as text. Every fragment of a dataset must have the
+    same schema: an empty categorical would be stored with type null, and the width of the dictionary indices
+    depends on the number of ids, so either would break reading the fragments together.
+    Parameters:
+        df (dataFrame): Shard to write.
+        path (Path): Path of the fragment.
+
+    """
+
+    df.astype({"geoid": "string"}).to_parquet(path)
+
+
+def write_fragment(reader, path, bbox, fragment, reduce=None):
+    """
+    Reads a shard, reduces it and writes it as a GeoParquet fragment. Runs inside the joblib workers,
+    so that only the path of the fragment and the peak memory of the worker travel back to the parent process.
+    Parameters:
+        reader (function): Function reading a single shard, such as `get_streets`.
+        path (str): Path of the shard.
+        bbox (list): Array containing the bounding box, in format [x_min, y_min, x_max, y_max].
+        fragment (Path): Path of the fragment to write.
+        reduce (optional, function): Function applied to the shard (derived columns, filters, column selection).
+    Return:
+        (Path): Path of the fragment.
+        (float): Peak memory of the worker, in MB.
+
+    """
+
+    df = reader(path, bbox)
+    if reduce is not None:
+        df = reduce(df)
+    to_fragment(df, fragment)
+    return fragment, peak_memory()
+
+
+def ingest_shards(reader, pathfiles, bbox, target, reduce=None):
+    """
+    Writes every shard, cropped and reduced, as a fragment of a GeoParquet dataset. The fragments are
+    written to a scratch folder next to `target`, which is renamed once all workers are done.
+    Parameters:
+        reader (function): Function reading a single shard, such as `get_streets`.
+        pathfiles (list): Paths of the shards.
+        bbox (list): Array containing the bounding box, in format [x_min, y_min, x_max, y_max].
+        target (Path): Folder of the dataset.
+        reduce (optional, function): Function applied to every shard.
+    Return:
+        (Path): Folder of the dataset.
+
+    """
+
+    scratch = target.with_name(target.name + ".partial")
+    shutil.rmtree(scratch, ignore_errors=True)
+    scratch.mkdir(parents=True)
+
+    written = Parallel(n_jobs=N_CORES)(
+        delayed(write_fragment)(reader, path, bbox, scratch / f"{Path(path).stem}.parquet", reduce)
+        for path in pathfiles
+    )
+    memory_report(f"ingestion of {target.name}", peak=max((peak for _, peak in written), default=0))
+
+    scratch.rename(target)
+    return target
+
+
+def write_census_fragment(path, bbox, known, attributes, geometries):
+    """
+    Reads a sociodemographic shard and writes its population and new geometries as separate fragments.
+    Runs inside the joblib workers.
+    Parameters:
+        path (str): Path of the shard.
+        bbox (list): Array containing the bounding box, in format [x_min, y_min, x_max, y_max].
+        known (set): Ids of the sections already in the geometry store.
+        attributes (Path): Path of the population fragment.
+        geometries (Path): Path of the geometry fragment.
+    Return:
+        (float): Peak memory of the worker, in MB.
+
+    """
+
+    df, geoms = get_census(path, bbox, known)
+    to_fragment(df, attributes)
+    to_fragment(geoms, geometries)
+    return peak_memory()
+
+
+def ingest_census(pathfiles, bbox, target, store, vintage):
+    """
+    Writes the population of a sociodemographic vintage as a parquet dataset (`geoid`, `p_t`) and adds the
+    geometries of the sections not seen in previous vintages to the geometry store, deduplicated by `geoid`.
+    The new geometries are read in batches of up to MEMORY_BUDGET_MB, each one written as a fragment of the store.
+    Parameters:
+        pathfiles (list): Paths of the shards of the vintage.
+        bbox (list): Array containing the bounding box, in format [x_min, y_min, x_max, y_max].
+        target (Path): Folder of the population dataset of the vintage.
+        store (Path): Folder of the geometry store, with the fragments of every vintage adding sections.
+        vintage (int): Year of the data.
+    Return:
+        (Path): Folder of the population dataset.
+
+    """
+
+    if not pathfiles:
+        raise ValueError(f"No sociodemographic shards for {vintage}.")
+
+    known = set()
+    if store.is_dir():
+        known = set(pd.read_parquet(store, columns=["geoid"])["geoid"].astype(str))
+
+    scratch = target.with_name(target.name + ".partial")
+    shutil.rmtree(scratch, ignore_errors=True)
+    (scratch / "geometries").mkdir(parents=True)
+
+    peaks = Parallel(n_jobs=N_CORES)(
+        delayed(write_census_fragment)(
+            path,
+            bbox,
+            known,
+            scratch / f"{Path(path).stem}.parquet",
+            scratch / "geometries" / f"{Path(path).stem}.parquet",
+        )
+        for path in pathfiles
+    )
+    memory_report(f"ingestion of {target.name}", peak=max(peaks))
+
+    # New sections are added to the store batch by batch, within the memory budget
+    seen = set(known)
+    for i, geometries in enumerate(fragment_batches(scratch / "geometries")):
+        geometries = geometries[~geometries["geoid"].isin(seen)].drop_duplicates("geoid")
+        seen.update(geometries["geoid"].astype(str))
+        if len(geometries) > 0:
+            store.mkdir(parents=True, exist_ok=True)
+            to_fragment(geometries, store / f"{vintage}_{i}.parquet")
+    shutil.rmtree(scratch / "geometries")
+
+    # Every section of the vintage must be joinable to its geometry
+    sections = set(pd.read_parquet(scratch, columns=["geoid"])["geoid"])
+    if store.is_dir():
+        sections -= set(pd.read_parquet(store, columns=["geoid"])["geoid"])
+    if sections:
+        raise ValueError(
+            f"{len(sections)} sections of {vintage} are missing from the geometry store."
+        )
+
+    scratch.rename(target)
+    return target
+
+
+def read_fragments(target):
+    """
+    Assembles the fragments of a dataset into a single geoDataFrame. Arrow concatenates the
+    fragments as chunks of one table, which is converted once.
+    Parameters:
+        target (Path or list): Folder of the dataset, or list of fragments.
+    Return:
+        (geoDataFrame): Dataset with all the fragments.
+
+    """
+
+    if isinstance(target, list):
+        target = [str(fragment) for fragment in target]
+    df = gpd.read_parquet(target)
+    if LEAN_DTYPES:
+        df["geoid"] = df["geoid"].astype("category")
+    return df
+
+
+def fragment_size(path):
+    """
+    Uncompressed size of the data of a parquet fragment, in bytes, read from its metadata.
+    """
+
+    metadata = pq.ParquetFile(path).metadata
+    return sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+
+
+def fragment_batches(target):
+    """
+    Reads the fragments of a dataset in batches of up to MEMORY_BUDGET_MB of uncompressed data, so that the
+    next stage can reduce each batch before reading the following one. Without budget, the whole dataset
+    is read as a single batch. The budget only applies to these reads: the aggregation stage holds its
+    reduced inputs whole.
+    Parameters:
+        target (Path): Folder of the dataset.
+    Yields:
+        (geoDataFrame): Batch of fragments.
+
+    """
+
+    budget = None if MEMORY_BUDGET_MB is None else MEMORY_BUDGET_MB * 1024**2
+    batch, size = [], 0
+    for fragment in sorted(target.glob("*.parquet")):
+        fragment_bytes = fragment_size(fragment)
+        if batch and budget is not None and size + fragment_bytes > budget:
+            yield read_fragments(batch)
+            batch, size = [], 0
+        batch.append(fragment)
+        size += fragment_bytes
+
+    if batch:
+        yield read_fragments(batch)
+
+
+def concat_shards(frames):
+    """
+    Concatenates batches, merging the categories of `geoid` so that it stays categorical.
+    Parameters:
+        frames (list): List of dataframes with the same columns.
+    Return:
+        (dataFrame): Concatenated dataframe.
+
+    """
+
+    if LEAN_DTYPES:
+        categories = union_categoricals(
+            [df["geoid"] for df in frames], ignore_order=True
+        ).categories
+        for df in frames:
+            df["geoid"] = df["geoid"].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
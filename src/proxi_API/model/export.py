@@ -0,0 +1,295 @@
+# export.py
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import uuid
+import zlib
+import h3
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+import zstandard
+from pathlib import Path
+from proxi_API.data.settings import H3_ZOOM, YEAR, EXPORT_BATCH, EXPORT_CACHE_MB
+
+out = Path(__file__).parents[1] / "data" / "cities"
+exports = out / "exports"  # Exports already generated, served with range support
+
+media_types = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "geoparquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "gzip": "application/gzip",
+    "zstd": "application/zstd",
+}
+extensions = {
+    "ndjson": ".ndjson",
+    "csv": ".csv",
+    "geoparquet": ".parquet",
+    "arrow": ".arrows",
+    "gzip": ".gz",
+    "zstd": ".zst",
+    "none": "",
+}
+
+# GeoParquet metadata. Without crs, coordinates are (lon, lat) in WGS84
+geo_metadata = {
+    "version": "1.0.0",
+    "primary_column": "geometry",
+    "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Polygon"]}},
+}
+
+
+class Drain(io.RawIOBase):
+    """
+    Write-only file that keeps what is written until it is drained, so that the Arrow writers can be streamed.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def source(CITY, year=YEAR):
+    """
+    Path of the geometry-free cell table of a city.
+    """
+    return out / f"{CITY}_{H3_ZOOM}_{year}_cells.parquet"
+
+
+def available_columns(CITY, year=YEAR):
+    """
+    Lists the columns of the cell table of a city.
+    """
+    return pq.ParquetFile(source(CITY, year)).schema_arrow.names
+
+
+def etag(CITY, year, format, compression, columns):
+    """
+    Tag identifying an export. It changes whenever the city is set up again or the parameters change.
+
+    Parameters:
+        CITY (str): Name of the city
+        year (int): Vintage of the sociodemographic data
+        format (str): Format of the export
+        compression (str): Compression of the export
+        columns (list): Columns exported
+
+    Returns:
+        str: Quoted ETag
+    """
+    stat = os.stat(source(CITY, year))
+    key = json.dumps(
+        [CITY, year, stat.st_mtime_ns, stat.st_size, format, compression, columns]
+    )
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+
+def filename(CITY, year, format, compression):
+    """
+    Name of the exported file.
+    """
+    return f"{CITY}_{H3_ZOOM}_{year}{extensions[format]}{extensions[compression]}"
+
+
+def media_type(format, compression):
+    """
+    Media type of the exported file.
+    """
+    return media_types[format if compression == "none" else compression]
+
+
+def folder(CITY, year=YEAR):
+    """
+    Folder keeping the complete exports of a city.
+    """
+    return exports / f"{CITY}_{H3_ZOOM}_{year}"
+
+
+def cached(CITY, year, tag, format, compression):
+    """
+    Path where a complete export is kept once generated.
+    """
+    return folder(CITY, year) / f"{tag.strip(chr(34))}{extensions[format]}{extensions[compression]}"
+
+
+def purge(CITY, year=YEAR):
+    """
+    Removes the exports of a city, which no longer match its cell table once it is set up again.
+    """
+    shutil.rmtree(folder(CITY, year), ignore_errors=True)
+
+
+def evict(keep=None):
+    """
+    Removes the oldest complete exports until they fit in EXPORT_CACHE_MB.
+
+    Parameters:
+        keep (optional, Path): Export that must not be removed, such as the one just written
+    """
+    files = []
+    for path in exports.glob("*/*"):
+        if path.name.endswith(".partial") or path == keep:
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # Removed by another request meanwhile
+            continue
+        files.append((stat.st_mtime_ns, stat.st_size, path))
+
+    size = sum(file_size for _, file_size, _ in files)
+    if keep is not None and keep.is_file():
+        size += keep.stat().st_size
+    for _, file_size, path in sorted(files):
+        if size <= EXPORT_CACHE_MB * 1024**2:
+            break
+        path.unlink(missing_ok=True)
+        size -= file_size
+
+
+def compressor(compression):
+    """
+    Streaming compressor.
+
+    Returns:
+        tuple: Functions compressing a chunk and flushing what is left at the end
+    """
+    if compression == "gzip":
+        stream = zlib.compressobj(wbits=31)  # gzip container
+        return stream.compress, stream.flush
+    if compression == "zstd":
+        stream = zstandard.ZstdCompressor().compressobj()
+        return stream.compress, stream.flush
+    return bytes, bytes
+
+
+def hexagons(h3_ids):
+    """
+    Rebuilds the polygons of H3 cells from their IDs, as WKB in (lon, lat) order.
+    """
+    polygons = [
+        shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(h3_id)])
+        for h3_id in h3_ids
+    ]
+    return pa.array(shapely.to_wkb(polygons), pa.binary())
+
+
+def encode(CITY, year, format, columns):
+    """
+    Encodes the cell table of a city chunk by chunk, reading EXPORT_BATCH rows at a time.
+    The GeoParquet export adds the hexagons, rebuilt from `h3_id`.
+
+    Parameters:
+        CITY (str): Name of the city
+        year (int): Vintage of the sociodemographic data
+        format (str): One of ndjson, csv, geoparquet or arrow
+        columns (list): Columns to export
+
+    Yields:
+        bytes: Chunk of the export
+    """
+    table = pq.ParquetFile(source(CITY, year))
+    read = columns if format != "geoparquet" else list(dict.fromkeys(columns + ["h3_id"]))
+    schema = pa.schema([table.schema_arrow.field(col) for col in columns])
+    if format == "geoparquet":
+        schema = schema.append(pa.field("geometry", pa.binary()))
+        schema = schema.with_metadata({"geo": json.dumps(geo_metadata)})
+
+    sink = Drain()
+    if format == "geoparquet":
+        writer = pq.ParquetWriter(sink, schema)
+    elif format == "arrow":
+        writer = pa.ipc.new_stream(sink, schema)
+
+    for i, batch in enumerate(table.iter_batches(batch_size=EXPORT_BATCH, columns=read)):
+        if format == "ndjson":
+            df = batch.to_pandas()[columns]
+            yield df.to_json(orient="records", lines=True).encode()
+        elif format == "csv":
+            df = batch.to_pandas()[columns]
+            yield df.to_csv(index=False, header=i == 0).encode()
+        else:
+            chunk = pa.Table.from_batches([batch]).select(columns)
+            if format == "geoparquet":
+                geometry = hexagons(batch.column("h3_id").to_pylist())
+                chunk = chunk.append_column("geometry", geometry)
+            writer.write_table(chunk.replace_schema_metadata(schema.metadata))
+            yield sink.drain()
+
+    if format in ("geoparquet", "arrow"):
+        writer.close()  # Footer of the file or end of the stream
+        yield sink.drain()
+
+
+def stream(CITY, year, format, compression, columns, cache=None):
+    """
+    Streams an export, compressed. When a cache path is given, the export is also written there and
+    kept once it is complete, so that interrupted downloads can be resumed. The oldest exports are then
+    removed beyond EXPORT_CACHE_MB.
+
+    Parameters:
+        CITY (str): Name of the city
+        year (int): Vintage of the sociodemographic data
+        format (str): One of ndjson, csv, geoparquet or arrow
+        compression (str): One of none, gzip or zstd
+        columns (list): Columns to export
+        cache (optional, Path): Path where to keep the export
+
+    Yields:
+        bytes: Chunk of the export
+    """
+    compress, flush = compressor(compression)
+    partial = None
+    if cache is not None:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        partial = cache.with_name(f"{cache.name}.{uuid.uuid4().hex}.partial")
+        file = open(partial, "wb")
+
+    try:
+        for chunk in encode(CITY, year, format, columns):
+            data = compress(chunk)
+            if data:
+                if partial is not None:
+                    file.write(data)
+                yield data
+        data = flush()
+        if partial is not None:
+            file.write(data)
+            file.close()
+            partial.rename(cache)
+            partial = None
+            evict(cache)
+        yield data
+    finally:
+        if partial is not None:  # Download interrupted, drop the incomplete copy
+            file.close()
+            partial.unlink(missing_ok=True)
+
+
+def write(CITY, year, format, compression, columns, cache):
+    """
+    Generates an export to its cache path without sending it.
+    """
+    for _ in stream(CITY, year, format, compression, columns, cache):
+        pass
+    return cache
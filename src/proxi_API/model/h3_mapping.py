@@ -1,4 +1,5 @@
-from proxi_API.data.settings import H3_ZOOM
+from proxi_API.data.settings import H3_ZOOM, SHARD_ZOOM
+from proxi_API.model.sharding import dissolve_shards
 import h3
 
 
@@ -15,16 +16,17 @@ def get_h3_id(geometry, resolution):
 
     """
     centroid = geometry.centroid
-    return h3.latlng_to_cell(centroid.x, centroid.y, resolution)
+    return h3.latlng_to_cell(centroid.y, centroid.x, resolution)  # (lat, lon)
 
 
-def main(df, method="mean"):
+def main(df, method="mean", n_jobs=1):
     """
-    Computes the h3 cells covering a given dataset.
+    Computes the h3 cells covering a given dataset. Cells are sharded by their parent cell and dissolved in parallel.
 
     Parameters:
         df (GeoDataFrame): Dataframe with geometry info
         method (optional, str): Method of aggregation for large resolutions
+        n_jobs (optional, int): Number of processes
 
     Returns:
         GeoDataFrame: Dataframe converted to H3
@@ -37,13 +39,14 @@ def main(df, method="mean"):
     dic = {}
     for col in df.columns:
         if col != "geometry":
-            if df[col].dtype in ["int64", "float64"]:  # Numeric columns
+            if df[col].dtype in ["int64", "float64", "float32"]:  # Numeric columns
                 dic[col] = "sum"
             else:
                 dic[col] = "first"  # Non-numeric columns
     dic["h3_id"] = "first"  # Ensure h3_id is retained
     dic['proximity_time_foot'] = 'mean'
 
-    df_grouped = df.dissolve(by="h3_id", aggfunc=dic)
+    keys = df["h3_id"].map(lambda x: h3.cell_to_parent(x, SHARD_ZOOM)).values
+    df_grouped = dissolve_shards(df, keys, by="h3_id", aggfunc=dic, n_jobs=n_jobs)
 
     return df_grouped
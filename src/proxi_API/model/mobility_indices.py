@@ -1,7 +1,7 @@
 import geopandas as gpd
 import numpy as np
 from pathlib import Path
-from proxi_API.data.settings import H3_ZOOM
+from proxi_API.data.settings import H3_ZOOM, YEAR
 import inequality
 
 out = Path(__file__).parents[1] / "data" / "cities"
@@ -53,12 +53,13 @@ def main(agg):
     return agg
 
 
-def metric_comp(CITY, sliders):
+def metric_comp(CITY, sliders, year=YEAR):
     """
     Returns the proximity times and inequality metrics for the pedestrian categories, weighted by the input sliders.
 
     Parameters:
         sliders (array): Array of shape (6,) containing the numerical value for the weights of each pedestrian category.
+        year (optional, int): Vintage of the sociodemographic data.
 
     Returns:
         Dict: Dictionary containing the proximity and inequality metrics
@@ -67,7 +68,7 @@ def metric_comp(CITY, sliders):
 
     sliders = np.array(sliders)
     sliders = sliders / sum(sliders)
-    dataset = gpd.read_file(out / f"{CITY}_{H3_ZOOM}_agg.geojson")
+    dataset = gpd.read_file(out / f"{CITY}_{H3_ZOOM}_{year}_agg.geojson")
     params = [
         "residentes",
         "turistas",
@@ -1,15 +1,21 @@
 # setup_city.py
 
-import pandas as pd
 import geopandas as gpd
+import pandas as pd
 import os
-from joblib import Parallel, delayed
 from pathlib import Path
-from proxi_API.data.settings import N_CORES, H3_ZOOM
-from proxi_API.model.data_processing import get_city, get_streets
+from proxi_API.data.settings import N_CORES, H3_ZOOM, YEAR, EXPORT_BATCH
+from proxi_API.model.data_processing import (
+    get_streets,
+    ingest_shards,
+    ingest_census,
+    fragment_batches,
+    memory_report,
+)
 from proxi_API.model import data_aggregation
 from proxi_API.model import mobility_indices
 from proxi_API.model import h3_mapping
+from proxi_API.model import export
 import osmnx as ox
 import logging
 
@@ -23,7 +29,74 @@ out = Path(__file__).parents[1] / "data" / "cities"
 cols = data_aggregation.cols
 
 
-def main(CITY):
+def pedestrian_totals(pedestrian):
+    """
+    Weights the pedestrian ratios by the pedestrian index and keeps only the totals.
+
+    Parameters:
+        pedestrian (GeoDataFrame): Pedestrian shard
+
+    Returns:
+        GeoDataFrame: Shard with the `_total` columns, geometry and geoid
+    """
+    for col in cols:
+        pedestrian[col + "_total"] = pedestrian["imd"] * pedestrian[col]
+
+    return pedestrian[[x + "_total" for x in cols] + ["geom", "geoid"]]
+
+
+def available_years():
+    """
+    Lists the vintages of sociodemographic data present in `data/unica_sociodemographics`.
+
+    Returns:
+        list: Years with data, sorted, empty if the folder is missing
+    """
+    path = data / "unica_sociodemographics"
+    if not path.is_dir():
+        return []
+    return sorted(int(name) for name in os.listdir(path) if name.isdigit())
+
+
+def csv_files(path):
+    """
+    Lists the csv files of a folder.
+
+    Parameters:
+        path (Path): Folder to list
+
+    Returns:
+        list: Paths of the csv files
+    """
+    return [
+        path / name
+        for name in os.listdir(path)
+        if os.path.isfile(os.path.join(path, name)) and name.endswith(".csv")
+    ]
+
+
+def pair_geometries(proximity, store, pairs):
+    """
+    Computes the proximity cells intersecting the census sections of every fragment of the geometry store
+    that has not been paired yet. The pairs are stored by `geoid`, one fragment per geometry fragment.
+
+    Parameters:
+        proximity (GeoDataFrame): Dataset containing the information about proximity time
+        store (Path): Folder of the geometry store
+        pairs (Path): Folder of the cell-section pairs
+    """
+    pairs.mkdir(parents=True, exist_ok=True)
+    for fragment in sorted(store.glob("*.parquet")):
+        if (pairs / fragment.name).is_file():
+            continue
+        logger.info(f"Pairing census sections from {fragment.stem}.")
+        geometries = gpd.read_parquet(fragment).set_crs(proximity.crs)
+        index = data_aggregation.index_pairs(proximity, geometries)
+        index["geoid"] = geometries["geoid"].values[index.pop("row").values]
+        index.to_parquet(pairs / fragment.name)
+
+
+def main(CITY, years=None):
     """
     Setups the API for a specified city. It
     - Produces a bounding box for the city
@@ -32,17 +105,32 @@ def main(CITY):
     - Aggregates all data together
     - Dumps everything to disk
 
-    If data is already present, it skips computation.
+    Census geometries are shared by all the vintages: they are stored once, deduplicated by `geoid`,
+    and paired with the proximity cells. Each vintage only stores its attributes.
 
+    If data is already present, it skips computation.
 
+    Parameters:
+        CITY (str): City to setup
+        years (optional, list): Vintages of the sociodemographic data, YEAR by default
     """
-    if not Path(out / f"{CITY}_{H3_ZOOM}_agg.geojson").is_file():
-        # Check folder and create it if not
-        out.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Setting up model for {CITY}")
-        boundary = ox.geocode_to_gdf(CITY)
-        bbox = boundary.total_bounds
+    years = sorted(set(years)) if years else [YEAR]
+    pending = [
+        year
+        for year in years
+        if not Path(out / f"{CITY}_{H3_ZOOM}_{year}_agg.geojson").is_file()
+    ]
+    if not pending:
+        logger.info("Aggregated data already exists.")
+        return
+
+    # Check folder and create it if not
+    out.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Setting up model for {CITY}")
+    boundary = ox.geocode_to_gdf(CITY)
+    bbox = boundary.total_bounds
 
+    if not Path(out / f"{CITY}_{H3_ZOOM}_proximity.parquet").is_file():
         logger.info("Reading proximity time data.")
         # Reading the proximity time files and using them to establish the bounding box
         if CITY == 'Viladecans':
@@ -52,82 +140,87 @@ def main(CITY):
         proximity = proximity.cx[bbox[0] : bbox[2], bbox[1] : bbox[3]]
 
         proximity = proximity[['geometry', 'proximity_time_foot']]
-        
-
-        # If the file exists, we do not compute it
-        if not Path(out / f"{CITY}_{H3_ZOOM}_pedestrian.geojson").is_file():
-            path = data / "unica_pedestrian"
-            pathfiles = [
-                name
-                for name in os.listdir(path)
-                if os.path.isfile(os.path.join(path, name)) and name.endswith(".csv")
-            ]
-            pathfiles = [path / file for file in pathfiles]
-
-            logger.info("Computing pedestrian data.")
-
-            result = Parallel(n_jobs=N_CORES)(
-                delayed(get_streets)(path, bbox) for path in pathfiles
-            )
-            pedestrian = pd.concat(result).reset_index(drop=True)
-
-            for col in cols:
-                pedestrian[col + "_total"] = pedestrian["imd"] * pedestrian[col]
-
-            pedestrian = pedestrian.set_crs(proximity.crs)
-            pedestrian = pedestrian[[x + '_total' for x in cols]+ ['geom', 'geoid']]
-            pedestrian.to_file(
-                out / f"{CITY}_{H3_ZOOM}_pedestrian.geojson", driver="GeoJSON"
+        proximity.to_parquet(out / f"{CITY}_{H3_ZOOM}_proximity.parquet")
+    else:
+        logger.info("Reading proximity time data from disk.")
+        proximity = gpd.read_parquet(out / f"{CITY}_{H3_ZOOM}_proximity.parquet")
+    memory_report("proximity time", proximity)
+
+    # If the file exists, we do not compute it
+    if not Path(out / f"{CITY}_{H3_ZOOM}_pedestrian.parquet").is_dir():
+        logger.info("Computing pedestrian data.")
+
+        ingest_shards(
+            get_streets,
+            csv_files(data / "unica_pedestrian"),
+            bbox,
+            out / f"{CITY}_{H3_ZOOM}_pedestrian.parquet",
+            pedestrian_totals,
+        )
+        logger.info("Pedestrian dataset saved to folder.")
+    else:
+        logger.info("Reading pedestrian data from disk.")
+
+    # The streets are paired and sharded once, further vintages read them back without geometry
+    pairs = out / f"{CITY}_{H3_ZOOM}_pairs_pedestrian.parquet"
+    prepared = out / f"{CITY}_{H3_ZOOM}_streets.parquet"
+    if pairs.is_file() and prepared.is_file():
+        logger.info("Reading prepared streets from disk.")
+        streets = pd.read_parquet(prepared)
+        pedestrian_pairs = pd.read_parquet(pairs)
+    else:
+        streets, pedestrian_pairs = data_aggregation.prepare_streets(
+            fragment_batches(out / f"{CITY}_{H3_ZOOM}_pedestrian.parquet"), proximity
+        )
+        streets.to_parquet(prepared)
+        pedestrian_pairs.to_parquet(pairs)
+    memory_report("street preparation", streets)
+
+    store = out / f"{CITY}_{H3_ZOOM}_demo.parquet"
+    for year in pending:
+        if not Path(out / f"{CITY}_{H3_ZOOM}_demo_{year}.parquet").is_dir():
+            logger.info(f"Computing demographics data for {year}.")
+            ingest_census(
+                csv_files(data / "unica_sociodemographics" / str(year)),
+                bbox,
+                out / f"{CITY}_{H3_ZOOM}_demo_{year}.parquet",
+                store,
+                year,
             )
-            logger.info("Pedestrian dataset saved to folder.")
-        else:
-            logger.info("Reading pedestrian data from disk.")
-
-            pedestrian = gpd.read_file(out / f"{CITY}_{H3_ZOOM}_pedestrian.geojson")
-
-        if not Path(out / f"{CITY}_{H3_ZOOM}_demo.geojson").is_file():
-            path = data / "unica_sociodemographics/2024/"
-            pathfiles = [
-                name
-                for name in os.listdir(path)
-                if os.path.isfile(os.path.join(path, name)) and name.endswith(".csv")
-            ]
-            pathfiles = [path / file for file in pathfiles]
+            logger.info("Demographic dataset saved to temp folder.")
 
-            logger.info("Computing demographics data.")
+    pair_geometries(proximity, store, out / f"{CITY}_{H3_ZOOM}_pairs_demo.parquet")
+    demo_pairs = pd.read_parquet(out / f"{CITY}_{H3_ZOOM}_pairs_demo.parquet")
 
-            result = Parallel(n_jobs=N_CORES)(
-                delayed(get_city)(path, bbox) for path in pathfiles
-            )
-            sdemo = pd.concat(result)
-            sdemo["do_date"] = pd.to_datetime(sdemo.do_date)
-            sdemo = sdemo[sdemo["p_t"] != 0][['p_t','geom', 'geoid' ]]
-            sdemo = sdemo.set_crs(proximity.crs)
-            sdemo.to_file(out / f"{CITY}_{H3_ZOOM}_demo.geojson", driver="GeoJSON")
-            logger.info("Demographic dataset saved to temp folder.")
-        else:
-            logger.info("Reading demographic data from disk.")
-            sdemo = gpd.read_file(out / f"{CITY}_{H3_ZOOM}_demo.geojson")
+    for year in pending:
+        sdemo = pd.read_parquet(out / f"{CITY}_{H3_ZOOM}_demo_{year}.parquet")
+        memory_report(f"demographics {year}", sdemo)
 
-        logger.info("Aggregating data.")
-        agg = data_aggregation.main(pedestrian, proximity, sdemo)
+        logger.info(f"Aggregating data for {year}.")
+        agg = data_aggregation.main(
+            proximity, streets, pedestrian_pairs, demo_pairs, sdemo, N_CORES
+        )
+        memory_report("aggregation", agg)
         logger.info("Computing mobility indices")
         agg = mobility_indices.main(agg)
         agg = agg.reset_index(drop=True)
 
-        agg.to_file(out / f"{CITY}_{H3_ZOOM}_prov.geojson", driver="GeoJSON")
+        agg.to_file(out / f"{CITY}_{H3_ZOOM}_{year}_prov.geojson", driver="GeoJSON")
 
         logger.info("Mapping H3 cells")
-        agg = h3_mapping.main(agg)
+        agg = h3_mapping.main(agg, n_jobs=N_CORES)
+        memory_report("H3 mapping", agg)
 
         agg = agg.reset_index(drop=True)
-        agg.to_file(out / f"{CITY}_{H3_ZOOM}_agg.geojson", driver="GeoJSON")
+        agg.to_file(out / f"{CITY}_{H3_ZOOM}_{year}_agg.geojson", driver="GeoJSON")
+        # Every row is an H3 cell, the lookup index does not need the polygons
+        pd.DataFrame(agg.drop(columns="geometry")).to_parquet(
+            out / f"{CITY}_{H3_ZOOM}_{year}_cells.parquet", row_group_size=EXPORT_BATCH
+        )
+        export.purge(CITY, year)  # Exports of the previous cell table are stale
         logger.info("Aggregated data saved to disk.")
 
         mp = agg[["geometry", "proximity_time_foot"]]
-        mp.to_file(out / f"{CITY}_{H3_ZOOM}_map.geojson", driver="GeoJSON")
+        mp.to_file(out / f"{CITY}_{H3_ZOOM}_{year}_map.geojson", driver="GeoJSON")
 
         logger.info("Map saved to disk")
-
-    else:
-        logger.info("Aggregated data already exists.")
@@ -0,0 +1,74 @@
+# sharding.py
+
+import h3
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from proxi_API.data.settings import SHARD_ZOOM
+
+
+def shard_keys(geometry):
+    """
+    Assigns each geometry to the coarse H3 cell (SHARD_ZOOM) containing a point of it. The representative point
+    is used instead of the centroid: it is as good for bucketing and does not warn on geographic coordinates.
+
+    Parameters:
+        geometry (GeoSeries): Geometries to shard, in (lon, lat)
+
+    Returns:
+        array: Shard of each geometry
+    """
+    points = geometry.representative_point()
+    return np.array(
+        [h3.latlng_to_cell(y, x, SHARD_ZOOM) for x, y in zip(points.x, points.y)]
+    )
+
+
+def group_shards(keys, groups):
+    """
+    Moves all the members of a group to the same shard, the first one in order, so that no group is split.
+
+    Parameters:
+        keys (array): Shard of each row
+        groups (array): Group of each row
+
+    Returns:
+        array: Shard of each row
+    """
+    return pd.Series(keys).groupby(np.asarray(groups)).transform("min").values
+
+
+def dissolve(df, by, aggfunc, kwargs):
+    """
+    Dissolves a shard. Runs inside the joblib workers.
+    """
+    return df.dissolve(by=by, aggfunc=aggfunc, **kwargs)
+
+
+def dissolve_shards(df, keys, by, aggfunc, n_jobs=1, **kwargs):
+    """
+    Dissolves a dataset shard by shard in a process pool and merges the results.
+
+    Every group must lie in a single shard. Rows keep their whole geometry even when it crosses the boundary
+    of its shard, and a geometry needed by several shards (the halo) is copied into each of them, so every group
+    is dissolved from exactly the same rows, in the same order, as in the serial path. The shards are merged in
+    order and sorted by group, which gives the same output as dissolving the whole dataset.
+
+    Parameters:
+        df (GeoDataFrame): Dataset to dissolve
+        keys (array): Shard of each row
+        by (str): Column to group by
+        aggfunc (dict): Aggregation of each column
+        n_jobs (optional, int): Number of processes, 1 dissolves the whole dataset at once
+
+    Returns:
+        GeoDataFrame: Dissolved dataset
+    """
+    if n_jobs == 1:
+        return df.dissolve(by=by, aggfunc=aggfunc, **kwargs)
+
+    shards = [shard for _, shard in df.groupby(keys, sort=True)]
+    result = Parallel(n_jobs=n_jobs)(
+        delayed(dissolve)(shard, by, aggfunc, kwargs) for shard in shards
+    )
+    return pd.concat(result).sort_index(kind="stable")
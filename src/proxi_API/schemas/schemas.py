@@ -1,7 +1,7 @@
 # schemas.py
 
 from pydantic import BaseModel, Field, ConfigDict, conlist, field_validator
-from typing import Optional
+from typing import Literal, Optional
 import asyncio
 
 
@@ -22,4 +22,13 @@ class InputSliders(BaseModel):
     # Compras/ocio, acceso hostelería, acceso transporte público
 
 class InputCity(BaseModel):
-    city: str = 'Barcelona'
\ No newline at end of file
+    city: str = 'Barcelona'
+
+
+class InputPolygon(BaseModel):
+    type: Literal["Polygon"] = "Polygon"
+    coordinates: conlist(
+        conlist(conlist(float, min_length=2, max_length=2), min_length=4), min_length=1
+    )
+    # GeoJSON polygon, coordinates in (lon, lat) order: an exterior ring and optional holes,
+    # each ring closed, so with at least 4 positions
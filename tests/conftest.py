@@ -0,0 +1,69 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+from proxi_API.model import cell_index, export, setup_city
+
+bounds = (2.0, 41.0, 2.1, 41.1)  # Extent of the synthetic city
+
+
+def square(x, y, size):
+    return box(x, y, x + size, y + size).wkt
+
+
+def write_census(path, year, n=12, size=0.1 / 12):
+    """
+    Writes the census sections of a year as a grid, with a shard outside the city sorting first.
+    The diagonal sections are empty in 2023 and populated afterwards.
+    """
+    path.mkdir(parents=True)
+    outside = pd.DataFrame({"geoid": ["M1"], "p_t": [10.0], "geom": [square(-3.7, 40.4, size)]})
+    outside.to_csv(path / "demo_0.csv", index=False)
+
+    rows = []
+    for i in range(n):
+        for j in range(n):
+            p_t = 0.0 if (year == 2023 and i == j) else float(10 + i + j)
+            rows.append({"geoid": f"S{i:02d}{j:02d}", "p_t": p_t, "geom": square(2.0 + i * size, 41.0 + j * size, size)})
+    df = pd.DataFrame(rows)
+    df.iloc[: len(df) // 2].to_csv(path / "demo_1.csv", index=False)
+    df.iloc[len(df) // 2 :].to_csv(path / "demo_2.csv", index=False)
+
+
+@pytest.fixture
+def city(tmp_path, monkeypatch):
+    """
+    Synthetic city, Barcelona, with proximity, pedestrian and census data for 2023 and 2024.
+    """
+    data = tmp_path / "data"
+    out = data / "cities"
+    rng = np.random.default_rng(0)
+
+    size = 0.1 / 20
+    cells = [box(2.0 + i * size, 41.0 + j * size, 2.0 + (i + 1) * size, 41.0 + (j + 1) * size) for i in range(20) for j in range(20)]
+    proximity = gpd.GeoDataFrame({"proximity_time_foot": rng.uniform(1, 20, len(cells))}, geometry=cells, crs="EPSG:4326")
+    (data / "proximity_time_spain").mkdir(parents=True)
+    proximity.to_file(data / "proximity_time_spain" / "Barcelona.geojson", driver="GeoJSON")
+
+    columns = ["imd", "visita_tur_stica", "trabajadores_estudiantes", "residentes", "compras_ocio", "acceso_hosteler_a", "acceso_tpte_p_blico", "total"]
+    (data / "unica_pedestrian").mkdir(parents=True)
+    for k, (x0, n) in enumerate([(-3.7, 5), (2.0, 150), (2.05, 150)]):
+        df = pd.DataFrame(rng.uniform(0, 1, (n, len(columns))), columns=columns)
+        df["geoid"] = [f"P{k}{i:03d}" for i in range(n)]
+        x = x0 + rng.uniform(0, 0.045, n)
+        y = 41.0 + rng.uniform(0, 0.095, n) if x0 > 0 else 40.4 + rng.uniform(0, 0.01, n)
+        df["geom"] = [f"LINESTRING ({a} {b}, {a + 0.002} {b + 0.002})" for a, b in zip(x, y)]
+        df.to_csv(data / "unica_pedestrian" / f"{k}.csv", index=False)
+
+    for year in (2023, 2024):
+        write_census(data / "unica_sociodemographics" / str(year), year)
+
+    boundary = gpd.GeoDataFrame(geometry=[box(*bounds)], crs="EPSG:4326")
+    monkeypatch.setattr(setup_city.ox, "geocode_to_gdf", lambda city: boundary)
+    monkeypatch.setattr(setup_city, "data", data)
+    for module in (setup_city, cell_index, export):
+        monkeypatch.setattr(module, "out", out)
+    monkeypatch.setattr(export, "exports", out / "exports")
+    cell_index.indices.clear()
+    return out
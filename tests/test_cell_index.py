@@ -0,0 +1,94 @@
+import threading
+import time
+import h3
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+from proxi_API import app
+from proxi_API.data.settings import H3_ZOOM
+from proxi_API.model import cell_index
+
+center = (41.05, 2.05)  # (lat, lon)
+
+
+@pytest.fixture
+def cells(tmp_path, monkeypatch):
+    """
+    Cell table of a city made of the cells around a point.
+    """
+    h3_ids = sorted(h3.grid_disk(h3.latlng_to_cell(*center, H3_ZOOM), 5))
+    df = pd.DataFrame({"h3_id": h3_ids, "proximity_time_foot": range(len(h3_ids))})
+    df.to_parquet(tmp_path / f"Barcelona_{H3_ZOOM}_2024_cells.parquet")
+    monkeypatch.setattr(cell_index, "out", tmp_path)
+    cell_index.indices.clear()
+    return h3_ids
+
+
+def test_point(cells):
+    client = TestClient(app)
+    response = client.get("/point/Barcelona", params={"lat": center[0], "lon": center[1], "geometry": True})
+    assert response.status_code == 200
+    assert response.json()["h3_id"] == h3.latlng_to_cell(*center, H3_ZOOM)
+    assert response.json()["geometry"]["type"] == "Polygon"
+
+    response = client.get("/point/Barcelona", params={"lat": 40.4, "lon": -3.7})
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("lat, lon", [("nan", 2.0), (91, 2.0), (41.0, -181)])
+def test_point_rejects_invalid_coordinates(cells, lat, lon):
+    response = TestClient(app).get("/point/Barcelona", params={"lat": lat, "lon": lon})
+    assert response.status_code == 422
+
+
+def test_polygon_is_clipped_to_the_city(cells, monkeypatch):
+    # Record how many cells the query covers once clipped
+    covered = []
+    polygon_to_cells = h3.polygon_to_cells
+
+    def counting(*args):
+        result = polygon_to_cells(*args)
+        covered.append(len(result))
+        return result
+
+    monkeypatch.setattr(cell_index.h3, "polygon_to_cells", counting)
+    spain = [[[-9.5, 36.0], [3.5, 36.0], [3.5, 43.8], [-9.5, 43.8], [-9.5, 36.0]]]
+    response = TestClient(app).post("/polygon/Barcelona", json={"type": "Polygon", "coordinates": spain})
+    assert response.status_code == 200
+    assert sorted(record["h3_id"] for record in response.json()) == cells
+    assert covered and covered[0] < 2 * len(cells)
+
+
+@pytest.mark.parametrize("coordinates", [[], [[[2.0, 41.0], [2.1, 41.0], [2.0, 41.0]]]])
+def test_polygon_rejects_invalid_rings(cells, coordinates):
+    response = TestClient(app).post("/polygon/Barcelona", json={"type": "Polygon", "coordinates": coordinates})
+    assert response.status_code == 422
+
+
+def test_concurrent_load_publishes_the_extent(cells, monkeypatch):
+    # The first load is held while computing the extent, and a second lookup arrives meanwhile
+    computing, release = threading.Event(), threading.Event()
+    extent = cell_index.extent
+
+    def slow_extent(index):
+        computing.set()
+        release.wait(5)
+        return extent(index)
+
+    monkeypatch.setattr(cell_index, "extent", slow_extent)
+    area = {"type": "Polygon", "coordinates": [[[1.9, 40.9], [2.2, 40.9], [2.2, 41.2], [1.9, 41.2], [1.9, 40.9]]]}
+    results = []
+
+    def lookup():
+        results.append(cell_index.polygon("Barcelona", area, 2024))
+
+    threads = [threading.Thread(target=lookup) for _ in range(2)]
+    threads[0].start()
+    computing.wait(5)
+    threads[1].start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert [sorted(record["h3_id"] for record in result) for result in results] == [cells, cells]
@@ -0,0 +1,55 @@
+import pandas as pd
+from proxi_API.model.data_processing import ingest_shards, get_streets, read_fragments
+from proxi_API.model.setup_city import pedestrian_totals
+
+bbox = [2.0, 41.0, 2.5, 41.5]
+columns = [
+    "imd",
+    "visita_tur_stica",
+    "trabajadores_estudiantes",
+    "residentes",
+    "compras_ocio",
+    "acceso_hosteler_a",
+    "acceso_tpte_p_blico",
+    "total",
+]
+
+
+def write_streets(path, x, y, ids):
+    """
+    Writes a pedestrian shard with one street per id, starting at (x, y).
+    """
+    df = pd.DataFrame({col: 1.0 for col in columns}, index=range(len(ids)))
+    df["geoid"] = ids
+    df["geom"] = [f"LINESTRING ({x + i * 0.001} {y}, {x + i * 0.001} {y + 0.001})" for i in range(len(ids))]
+    df.to_csv(path, index=False)
+
+
+def test_empty_first_shard(tmp_path):
+    # National shards cropped to a city are mostly empty, the first fragment must not fix the schema
+    write_streets(tmp_path / "0_outside.csv", -3.7, 40.4, ["m1", "m2"])
+    write_streets(tmp_path / "1.csv", 2.1, 41.1, [f"a{i}" for i in range(3)])
+    write_streets(tmp_path / "2.csv", 2.2, 41.2, [f"b{i}" for i in range(200)])
+
+    target = ingest_shards(
+        get_streets,
+        sorted(tmp_path.glob("*.csv")),
+        bbox,
+        tmp_path / "pedestrian.parquet",
+        pedestrian_totals,
+    )
+    pedestrian = read_fragments(target)
+
+    assert len(pedestrian) == 203
+    assert pedestrian["geoid"].notna().all()
+    assert set(pedestrian["geoid"]) == {f"a{i}" for i in range(3)} | {f"b{i}" for i in range(200)}
+    assert (pedestrian["residentes_total"] == 1).all()
+
+
+def test_ingestion_reports_worker_memory(tmp_path, caplog):
+    write_streets(tmp_path / "0.csv", 2.1, 41.1, ["a0", "a1"])
+
+    with caplog.at_level("INFO", logger="uvicorn.error"):
+        ingest_shards(get_streets, [tmp_path / "0.csv"], bbox, tmp_path / "pedestrian.parquet")
+
+    assert "Memory at ingestion of pedestrian.parquet: peak RSS of the workers" in caplog.text
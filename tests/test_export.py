@@ -0,0 +1,79 @@
+import io
+import geopandas as gpd
+import h3
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+from proxi_API import app
+from proxi_API.data.settings import H3_ZOOM
+from proxi_API.model import export
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """
+    Client for a city whose cell table has a few thousand cells.
+    """
+    h3_ids = sorted(h3.grid_disk(h3.latlng_to_cell(41.05, 2.05, H3_ZOOM), 30))
+    df = pd.DataFrame({"h3_id": h3_ids, "proximity_time_foot": [i / 7 for i in range(len(h3_ids))]})
+    df.to_parquet(tmp_path / f"Barcelona_{H3_ZOOM}_2024_cells.parquet", row_group_size=1000)
+    monkeypatch.setattr(export, "out", tmp_path)
+    monkeypatch.setattr(export, "exports", tmp_path / "exports")
+    return TestClient(app)
+
+
+def test_resume_download(client):
+    full = client.get("/export/Barcelona", params={"format": "csv", "compression": "gzip"})
+    assert full.status_code == 200
+    tag = full.headers["etag"]
+
+    headers = {"range": "bytes=100-199", "if-range": tag}
+    part = client.get("/export/Barcelona", params={"format": "csv", "compression": "gzip"}, headers=headers)
+    assert part.status_code == 206
+    assert part.content == full.content[100:200]
+
+    # A different version of the file sends it whole
+    headers = {"range": "bytes=100-199", "if-range": '"stale"'}
+    whole = client.get("/export/Barcelona", params={"format": "csv", "compression": "gzip"}, headers=headers)
+    assert whole.status_code == 200
+    assert whole.content == full.content
+
+
+def test_range_before_export_exists(client):
+    part = client.get("/export/Barcelona", params={"format": "ndjson"}, headers={"range": "bytes=0-9"})
+    assert part.status_code == 206
+    full = client.get("/export/Barcelona", params={"format": "ndjson"})
+    assert part.content == full.content[:10]
+
+
+@pytest.mark.parametrize("format", ["ndjson", "csv", "geoparquet", "arrow"])
+def test_formats(client, format):
+    response = client.get("/export/Barcelona", params={"format": format, "columns": ["h3_id"]})
+    assert response.status_code == 200
+    assert len(response.content) > 0
+
+
+def test_geoparquet_has_hexagons(client):
+    response = client.get("/export/Barcelona", params={"format": "geoparquet", "compression": "none"})
+    cells = gpd.read_parquet(io.BytesIO(response.content))
+    assert len(cells) == len(h3.grid_disk(h3.latlng_to_cell(41.05, 2.05, H3_ZOOM), 30))
+    assert (cells.geom_type == "Polygon").all()
+
+
+def test_column_order_shares_the_export(client):
+    first = client.get("/export/Barcelona", params={"columns": ["proximity_time_foot", "h3_id"]})
+    second = client.get("/export/Barcelona", params={"columns": ["h3_id", "proximity_time_foot"]})
+    assert first.headers["etag"] == second.headers["etag"]
+    assert len(list(export.exports.glob("*/*"))) == 1
+
+
+def test_exports_are_bounded(client, monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_CACHE_MB", 0)
+    for format in ("ndjson", "csv", "arrow"):
+        response = client.get("/export/Barcelona", params={"format": format})
+        assert response.status_code == 200
+    # Only the export just written is kept beyond the budget
+    assert [path.suffix for path in export.exports.glob("*/*")] == [".arrows"]
+
+    export.purge("Barcelona", 2024)
+    assert list(export.exports.glob("*/*")) == []
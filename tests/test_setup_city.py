@@ -0,0 +1,87 @@
+import shutil
+import pytest
+import geopandas as gpd
+import pandas as pd
+from fastapi.testclient import TestClient
+from geopandas.testing import assert_geodataframe_equal
+from proxi_API import app
+from proxi_API.data.settings import H3_ZOOM
+from proxi_API.model import data_processing, setup_city
+
+
+def test_vintages_share_geometry_store(city):
+    setup_city.main("Barcelona", [2023])
+    setup_city.main("Barcelona", [2024])
+
+    store = gpd.read_parquet(city / f"Barcelona_{H3_ZOOM}_demo.parquet")
+    assert store["geoid"].notna().all()
+    assert store["geoid"].is_unique
+    for year in (2023, 2024):
+        sdemo = pd.read_parquet(city / f"Barcelona_{H3_ZOOM}_demo_{year}.parquet")
+        assert set(sdemo["geoid"]) <= set(store["geoid"])
+
+    # Sections empty in 2023 are added to the store by 2024
+    assert {"S0000", "S0505"} <= set(store["geoid"])
+    sdemo = pd.read_parquet(city / f"Barcelona_{H3_ZOOM}_demo_2024.parquet")
+    assert len(sdemo) == 144
+    assert "M1" not in set(sdemo["geoid"])
+
+    agg_2023 = gpd.read_file(city / f"Barcelona_{H3_ZOOM}_2023_prov.geojson")
+    agg_2024 = gpd.read_file(city / f"Barcelona_{H3_ZOOM}_2024_prov.geojson")
+    assert len(agg_2024) >= len(agg_2023) > 0
+    assert agg_2024["p_t"].sum() > agg_2023["p_t"].sum()
+
+
+def test_memory_budget_batches(city, monkeypatch):
+    setup_city.main("Barcelona", [2024])
+    whole = gpd.read_file(city / f"Barcelona_{H3_ZOOM}_2024_agg.geojson")
+
+    # Reading every fragment on its own must not change the result
+    for path in city.iterdir():
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+    monkeypatch.setattr(data_processing, "MEMORY_BUDGET_MB", 0)
+    setup_city.main("Barcelona", [2024])
+    batched = gpd.read_file(city / f"Barcelona_{H3_ZOOM}_2024_agg.geojson")
+
+    assert len(list((city / f"Barcelona_{H3_ZOOM}_demo.parquet").glob("*.parquet"))) == 2
+    assert_geodataframe_equal(batched, whole)
+
+
+def test_sharded_aggregation_matches_serial(city, monkeypatch):
+    monkeypatch.setattr(setup_city, "N_CORES", 1)
+    setup_city.main("Barcelona", [2024])
+    serial = gpd.read_file(city / f"Barcelona_{H3_ZOOM}_2024_agg.geojson")
+    (city / f"Barcelona_{H3_ZOOM}_2024_agg.geojson").unlink()
+
+    monkeypatch.setattr(setup_city, "N_CORES", 3)
+    setup_city.main("Barcelona", [2024])
+    sharded = gpd.read_file(city / f"Barcelona_{H3_ZOOM}_2024_agg.geojson")
+
+    assert_geodataframe_equal(sharded, serial)
+
+
+def test_new_vintage_reuses_prepared_streets(city, monkeypatch):
+    setup_city.main("Barcelona", [2023])
+
+    def unexpected(target):
+        raise AssertionError("pedestrian fragments read again")
+
+    monkeypatch.setattr(setup_city, "fragment_batches", unexpected)
+    setup_city.main("Barcelona", [2024])
+    assert (city / f"Barcelona_{H3_ZOOM}_2024_agg.geojson").is_file()
+
+
+def test_empty_vintage(city):
+    (city.parent / "unica_sociodemographics" / "2025").mkdir()
+    with pytest.raises(ValueError, match="2025"):
+        setup_city.main("Barcelona", [2025])
+
+
+def test_missing_sociodemographics(city):
+    shutil.rmtree(city.parent / "unica_sociodemographics")
+    assert setup_city.available_years() == []
+    response = TestClient(app).get("/setup/Barcelona", params={"year": 2024})
+    assert response.status_code == 404
@@ -0,0 +1,17 @@
+import warnings
+import geopandas as gpd
+from shapely.geometry import box
+from proxi_API.model.sharding import shard_keys, group_shards
+
+
+def test_shard_keys_on_geographic_crs():
+    geometry = gpd.GeoSeries([box(2.0, 41.0, 2.01, 41.01), box(2.5, 41.5, 2.51, 41.51)], crs="EPSG:4326")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        keys = shard_keys(geometry)
+    assert keys[0] != keys[1]
+
+
+def test_groups_are_not_split():
+    keys = group_shards(["b", "a", "c", "b"], ["x", "x", "y", "y"])
+    assert list(keys) == ["a", "a", "b", "b"]